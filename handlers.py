@@ -1,63 +1,129 @@
-import itertools
-import json
+import asyncio
+import collections
+import time
 import typing
+import urllib.parse
 from abc import ABC
 
+import orjson
+import tornado.iostream
 import tornado.web
 import ts3_api
 
+_dumps = orjson.dumps
 
-def ts3_api_call_wrapper(handler: tornado.web.RequestHandler, call_func) -> typing.Union[bool, typing.List[typing.Dict[str, str]], typing.Dict[str, str]]:
-	try:
-		return call_func()
-	except ts3_api.TS3APIInternalError as e:
+# Seconds the serialized /state response is reused for
+STATE_CACHE_TTL = 2.0
+
+# Number of known clients returned by /clients/known if no limit is given
+KNOWN_CLIENTS_DEFAULT_LIMIT = 500
+
+# Number of list entries serialized and flushed at once when streaming a response
+STREAM_CHUNK_SIZE = 100
+
+
+def write_ts3_api_error(handler: tornado.web.RequestHandler, exception: BaseException):
+	if isinstance(exception, ts3_api.TS3APIInternalError):
 		handler.set_status(500)
-		exception = e
-	except ts3_api.TS3APINotFoundError as e:
+	elif isinstance(exception, ts3_api.TS3APINotFoundError):
 		handler.set_status(404)
-		exception = e
-	except ts3_api.TS3APIBadRequestError as e:
+	elif isinstance(exception, ts3_api.TS3APIBadRequestError):
 		handler.set_status(400)
-		exception = e
+	else:
+		raise exception
 
 	handler.write(str(exception))
-	return False
+
+
+async def ts3_api_call_wrapper(handler: tornado.web.RequestHandler, call_func) -> typing.Union[bool, typing.List[typing.Dict[str, str]], typing.Dict[str, str]]:
+	try:
+		return await call_func()
+	except (ts3_api.TS3APIInternalError, ts3_api.TS3APINotFoundError, ts3_api.TS3APIBadRequestError) as e:
+		write_ts3_api_error(handler, e)
+		return False
 
 
 class AbstractRequestHandler(tornado.web.RequestHandler, ABC):
 	def initialize(self, api):
 		self.api: ts3_api.TeamSpeak3ServerAPI = api
 
+	async def write_json_list(self, items: typing.List[typing.Dict[str, str]]):
+		self.set_header("Content-Type", "application/json")
+		self.write(b"[")
+
+		for start in range(0, len(items), STREAM_CHUNK_SIZE):
+			if start > 0:
+				self.write(b",")
 
-class StateHandler(AbstractRequestHandler, ABC):
-	def get(self):
-		# Fetch server name and description
-		result = ts3_api_call_wrapper(self, self.api.get_server_name_description)
-		if not result:
-			return
+			# Strip the brackets of each encoded chunk so that all chunks form a single list
+			self.write(_dumps(items[start:start + STREAM_CHUNK_SIZE])[1:-1])
 
-		server_name, server_description = result
+			try:
+				await self.flush()
+			except tornado.iostream.StreamClosedError:
+				# The client disconnected, nobody is left to receive the rest
+				return
 
-		# Fetch channel information
-		channel_list = ts3_api_call_wrapper(self, self.api.get_channel_list)
-		if not channel_list:
-			return
+		self.write(b"]")
 
-		# Convert channel list to dict
-		channels = {int(channel["channel_id"]): channel for channel in channel_list}
 
-		# Fetch online client information
-		online_clients_list = ts3_api_call_wrapper(self, self.api.get_online_clients)
-		if not online_clients_list:
-			return
+class StateHandler(AbstractRequestHandler, ABC):
+	async def get(self):
+		# Serve bursts of requests from the cached response, concurrent requests wait for a single rebuild
+		async with self.api.state_cache_lock:
+			state_cache = self.api.state_cache
+			if state_cache is None or time.monotonic() - state_cache[0] >= STATE_CACHE_TTL:
+				state = await self.build_state()
+				if state is None:
+					return
+
+				state_cache = (time.monotonic(), state)
+				self.api.state_cache = state_cache
+
+		self.set_header("Content-Type", "application/json")
+		self.write(state_cache[1])
+
+	async def build_state(self) -> typing.Optional[bytes]:
+		# Fetch server name and description, channel information and online client information concurrently
+		results = await asyncio.gather(
+			self.api.get_server_name_description(),
+			self.api.get_channel_list(),
+			self.api.get_online_clients(),
+			return_exceptions=True
+		)
+
+		for result in results:
+			if isinstance(result, BaseException):
+				write_ts3_api_error(self, result)
+				return None
+
+		(server_name, server_description), channel_list, online_clients_list = results
+		if not channel_list or not online_clients_list:
+			return None
 
 		# Group online clients by channel id and drop channel id
-		online_clients_list = sorted(online_clients_list, key=lambda client: client["channel_id"])
-		online_clients_by_channel = itertools.groupby(online_clients_list, key=lambda client: int(client["channel_id"]))
-		online_clients_by_channels = {int(channel_id): list(clients) for channel_id, clients in online_clients_by_channel}
-		for online_clients_in_channel in online_clients_by_channels.values():
-			for client in online_clients_in_channel:
-				del client["channel_id"]
+		online_clients_by_channels = collections.defaultdict(list)
+		for client in online_clients_list:
+			online_clients_by_channels[int(client.pop("channel_id"))].append(client)
+
+		# Convert channel list to dict and move the ids out of the channels, they are not part of the output
+		channels = {}
+		parent_channel_ids = {}
+		for channel in channel_list:
+			channel_id = int(channel.pop("channel_id"))
+			parent_channel_ids[channel_id] = int(channel.pop("pid"))
+			channels[channel_id] = channel
+
+			if int(channel["total_clients"]) > 0:
+				# Insert clients into channel
+				del channel["total_clients"]
+				channel["clients"] = online_clients_by_channels.get(channel_id, [])
+
+		# Only channels that actually have sub channels get a list for them
+		# This happens after inserting the clients to keep "clients" ahead of "channels" in the output
+		for parent_channel_id in set(parent_channel_ids.values()):
+			if parent_channel_id != 0:
+				channels[parent_channel_id]["channels"] = []
 
 		# Put channels into hierarchical order and make id names more intuitive
 		# Channels are already in the same order as on the teamspeak
@@ -68,69 +134,69 @@ class StateHandler(AbstractRequestHandler, ABC):
 		}
 		hierarchical_channels = hierarchy["channels"]
 
-		for channel in channels.values():
-			parent_channel_id = int(channel["pid"])
-			del channel["pid"]
-
-			channel_id = int(channel["channel_id"])
-			del channel["channel_id"]
-
-			if int(channel["total_clients"]) > 0:
-				# Insert clients into channel
-				del channel["total_clients"]
-				channel["clients"] = online_clients_by_channels[channel_id]
-
+		for channel_id, channel in channels.items():
+			parent_channel_id = parent_channel_ids[channel_id]
 			if parent_channel_id == 0:
 				# Add channel to the top of the hierarchy
 				hierarchical_channels.append(channel)
 			else:
 				# Add this channel to its parent channel
-				parent_channel = channels[parent_channel_id]
-
-				if "channels" not in parent_channel:
-					parent_channel["channels"] = []
+				channels[parent_channel_id]["channels"].append(channel)
 
-				parent_channel["channels"].append(channel)
-
-		self.set_header("Content-Type", "application/json")
-		self.write(json.dumps(hierarchy))
+		return _dumps(hierarchy)
 
 
 class KnownClientsHandler(AbstractRequestHandler, ABC):
-	def get(self, last_seen_after: str = None):
-		known_clients = ts3_api_call_wrapper(self, self.api.get_known_clients)
+	async def get(self, last_seen_after: str = None):
+		try:
+			limit = int(self.get_argument("limit", str(KNOWN_CLIENTS_DEFAULT_LIMIT)))
+			offset = int(self.get_argument("offset", "0"))
+		except ValueError:
+			limit = offset = -1
+
+		if limit < 1 or offset < 0:
+			self.set_status(400)
+			self.write("Query parameter 'limit' has to be a positive and 'offset' a non-negative integer.")
+			return
+
+		known_clients = await ts3_api_call_wrapper(self, self.api.get_known_clients)
 		if not known_clients:
 			return
 
-		self.set_header("Content-Type", "application/json")
-		self.write(json.dumps(known_clients))
+		# Point to the next page if there are more clients
+		next_offset = offset + limit
+		if next_offset < len(known_clients):
+			next_query = urllib.parse.urlencode({"limit": limit, "offset": next_offset})
+			self.set_header("Link", f'<{self.request.path}?{next_query}>; rel="next"')
+
+		await self.write_json_list(known_clients[offset:next_offset])
 
 
 class OnlineClientsHandler(AbstractRequestHandler, ABC):
-	def get(self):
-		online_clients = ts3_api_call_wrapper(self, self.api.get_online_clients)
+	async def get(self):
+		online_clients = await ts3_api_call_wrapper(self, self.api.get_online_clients)
 		if not online_clients:
 			return
 
 		self.set_header("Content-Type", "application/json")
-		self.write(json.dumps(online_clients))
+		self.write(_dumps(online_clients))
 
 
 class OnlineClientInfoHandler(AbstractRequestHandler, ABC):
-	def get(self, online_client_id):
-		online_client_info = ts3_api_call_wrapper(self, lambda: self.api.get_online_client_info(online_client_id))
+	async def get(self, online_client_id):
+		online_client_info = await ts3_api_call_wrapper(self, lambda: self.api.get_online_client_info(online_client_id))
 		if not online_client_info:
 			return
 
 		self.set_header("Content-Type", "application/json")
-		self.write(json.dumps(online_client_info))
+		self.write(_dumps(online_client_info))
 
 
 class KnownClientInfoHandler(AbstractRequestHandler, ABC):
-	def get(self, known_client_id):
-		known_client_info = ts3_api_call_wrapper(self, lambda: self.api.get_known_client_info(known_client_id))
+	async def get(self, known_client_id):
+		known_client_info = await ts3_api_call_wrapper(self, lambda: self.api.get_known_client_info(known_client_id))
 		if not known_client_info:
 			return
 
 		self.set_header("Content-Type", "application/json")
-		self.write(json.dumps(known_client_info))
+		self.write(_dumps(known_client_info))
@@ -1,17 +1,26 @@
 import argparse
 import json
 import logging
+import socket
+import sys
 
 import asyncio
 import typing
 
+import aiohttp
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
 import tornado.web
+import uvloop
 
 import ts3_api
 import handlers
 
 
-async def main(listen_addresses: typing.List[str], listen_port: int, api: ts3_api.TeamSpeak3ServerAPI):
+async def main(sockets: typing.List[socket.socket], api_config: typing.Dict[str, typing.Any]):
+	api = create_ts3_api(api_config)
+
 	app = tornado.web.Application([
 		(r"/state", handlers.StateHandler, {"api": api}),
 		(r"/clients/online", handlers.OnlineClientsHandler, {"api": api}),
@@ -20,10 +29,41 @@ async def main(listen_addresses: typing.List[str], listen_port: int, api: ts3_ap
 		(r"/clients/known/(\d+)", handlers.KnownClientInfoHandler, {"api": api}),
 	])
 
-	for listen_address in listen_addresses:
-		app.listen(listen_port, listen_address)
+	server = tornado.httpserver.HTTPServer(app)
+	server.add_sockets(sockets)
+
+	# Optionally warm up the known client info cache in the background
+	# With multiple worker processes, only the first one warms up to not multiply the upstream load
+	warmup_task = None
+	warmup_limit = api_config.get("known_client_info_warmup_limit", 0)
+	if warmup_limit > 0 and tornado.process.task_id() in (0, None):
+		warmup_task = asyncio.create_task(warm_up_known_client_infos(api, warmup_limit))
+
+	try:
+		await asyncio.Event().wait()
+	finally:
+		if warmup_task is not None:
+			warmup_task.cancel()
+
+		await api.close()
 
-	await asyncio.Event().wait()
+
+async def warm_up_known_client_infos(api: ts3_api.TeamSpeak3ServerAPI, limit: int):
+	try:
+		known_clients = (await api.get_known_clients())[:limit]
+		num_fetched, num_failed = await api.prefetch_known_client_infos(
+			known_client["known_client_id"] for known_client in known_clients
+		)
+	except (
+		ts3_api.TS3APIInternalError, ts3_api.TS3APINotFoundError, ts3_api.TS3APIBadRequestError, aiohttp.ClientError
+	) as e:
+		logging.warning(f"Failed to warm up the known client info cache: {e}")
+		return
+
+	if num_failed > 0:
+		logging.warning(f"Failed to prefetch client info for {num_failed} of {num_fetched + num_failed} known clients")
+
+	logging.info(f"Prefetched client info for {num_fetched} known clients")
 
 
 def get_cli_args():
@@ -53,29 +93,62 @@ def setup_logging(verbose: bool, debug: bool):
 	)
 
 
+def bind_sockets(listen_addresses: typing.List[str], listen_port: int) -> typing.List[socket.socket]:
+	sockets = []
+	for listen_address in listen_addresses:
+		sockets.extend(tornado.netutil.bind_sockets(listen_port, address=listen_address))
+
+	return sockets
+
+
 def load_config(config_path: str):
 	with open(config_path, "r") as config_fh:
 		return json.load(config_fh)
 
 
-def setup_ts3_api(host: str, scheme: str, port: int, virtual_server_id: int, token: str):
-	api = ts3_api.TeamSpeak3ServerAPI(host, scheme, port, virtual_server_id, token)
+def create_ts3_api(api_config: typing.Dict[str, typing.Any]) -> ts3_api.TeamSpeak3ServerAPI:
+	return ts3_api.TeamSpeak3ServerAPI(
+		api_config["server_hostname"],
+		api_config["scheme"],
+		api_config["webquery_port"],
+		api_config["virtual_server_id"],
+		api_config["webquery_token"]
+	)
+
+
+async def check_ts3_api(api_config: typing.Dict[str, typing.Any]) -> bool:
+	api = create_ts3_api(api_config)
 
-	version_data = api.get_version()
-	logging.info(f"Connected to TeamSpeak3 Server at {host} ({version_data['platform']}, {version_data['version']})")
+	try:
+		version_data = await api.get_version()
+	except (
+		ts3_api.TS3APIInternalError, ts3_api.TS3APINotFoundError, ts3_api.TS3APIBadRequestError, aiohttp.ClientError
+	) as e:
+		logging.error(f"Failed to connect to TeamSpeak3 Server at {api.host}: {e}")
+		return False
+	finally:
+		await api.close()
 
-	return api
+	logging.info(f"Connected to TeamSpeak3 Server at {api.host} ({version_data['platform']}, {version_data['version']})")
+	return True
 
 
 if __name__ == "__main__":
 	args = get_cli_args()
 	setup_logging(args.verbose, args.debug)
 	config = load_config(args.config)
-	ts3_api = setup_ts3_api(
-		config["api"]["server_hostname"],
-		config["api"]["scheme"],
-		config["api"]["webquery_port"],
-		config["api"]["virtual_server_id"],
-		config["api"]["webquery_token"]
-	)
-	asyncio.run(main(config["server"]["listen_addresses"], config["server"]["listen_port"], ts3_api))
+	asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+	# Check the upstream connection once before forking, failing workers would be restarted over and over
+	if not asyncio.run(check_ts3_api(config["api"])):
+		sys.exit(1)
+
+	# Bind before forking so that all worker processes share the listening sockets
+	# Each worker has its own event loop, API session and caches
+	sockets = bind_sockets(config["server"]["listen_addresses"], config["server"]["listen_port"])
+
+	worker_processes = config["server"].get("worker_processes", 1)
+	if worker_processes != 1:
+		tornado.process.fork_processes(worker_processes)
+
+	asyncio.run(main(sockets, config["api"]))
@@ -1,8 +1,35 @@
-import json
-import re
+import asyncio
+import itertools
+import time
 import typing
 
-import requests
+import aiohttp
+import orjson
+
+# Fixed query parameters, shared between requests as they are never modified
+_CHANNEL_LIST_PARAMS = {
+	"-flags": "",
+	"-limits": "",
+	"-secondsempty": ""
+}
+
+_ONLINE_CLIENT_PARAMS = {
+	"-away": "",
+	"-voice": "",
+	"-times": "",
+	"-groups": "",
+	"-country": ""
+}
+
+# Seconds after which the known clients are downloaded completely again instead of only appending new ones,
+# so that the rows of already cached clients (last connection, nickname, ...) do not go stale
+KNOWN_CLIENTS_CACHE_MAX_AGE = 60.0
+
+# Seconds a fetched known client info is reused for
+KNOWN_CLIENT_INFO_CACHE_TTL = 30.0
+
+# Seconds to wait between the request batches of a known client info prefetch, to stay below the query flood limits
+PREFETCH_BATCH_INTERVAL = 1.0
 
 
 class TS3APIInternalError(Exception):
@@ -29,21 +56,45 @@ class TeamSpeak3ServerAPI:
 		self.virtual_server_id = virtual_server_id
 		self.token = token
 
-	def do_request(self, path: str, query_params: typing.Dict[str, str] = None):
-		cleaned_path = path
-		if path.startswith("/"):
-			cleaned_path = re.sub(r"^/+", "", path)
+		self._base_url = f"{scheme}://{host}:{port}/"
+
+		self._session: typing.Optional[aiohttp.ClientSession] = None
+
+		self.known_clients_cache: typing.List[typing.Dict[str, str]] = []
+		self._known_clients_rebuilt_at = 0.0
+		self._known_clients_lock = asyncio.Lock()
+		self._known_info_cache: typing.Dict[str, typing.Tuple[float, typing.Dict[str, str]]] = {}
 
-		auth_header = {"x-api-key": self.token}
-		response = requests.get(
-			f"{self.scheme}://{self.host}:{self.port}/{cleaned_path}",
-			headers=auth_header,
+		self.state_cache: typing.Optional[typing.Tuple[float, bytes]] = None
+		self.state_cache_lock = asyncio.Lock()
+
+	def _get_session(self) -> aiohttp.ClientSession:
+		# The session has to be created from within the running event loop, so do it on first use
+		if self._session is None or self._session.closed:
+			self._session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+				headers={"x-api-key": self.token}
+			)
+
+		return self._session
+
+	async def close(self):
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+	async def do_request(self, path: str, query_params: typing.Dict[str, str] = None):
+		cleaned_path = path.lstrip("/")
+
+		async with self._get_session().get(
+			self._base_url + cleaned_path,
 			params=query_params
-		)
+		) as response:
+			content = await response.read()
 
 		try:
-			data = response.json()
-		except json.JSONDecodeError as jde:
+			data = orjson.loads(content)
+		except orjson.JSONDecodeError as jde:
 			raise TS3APIInternalError(f"Failed to decode TeamSpeak3 server response as JSON: {jde}")
 
 		status = data.get("status")
@@ -71,8 +122,8 @@ class TeamSpeak3ServerAPI:
 
 		return body
 
-	def do_request_with_single_object_response(self, path: str, query_params: typing.Dict[str, str] = None):
-		response = self.do_request(path, query_params)
+	async def do_request_with_single_object_response(self, path: str, query_params: typing.Dict[str, str] = None):
+		response = await self.do_request(path, query_params)
 
 		if len(response) > 1:
 			raise TS3APIInternalError(f"Unexpectedly got more than one object in response.")
@@ -81,95 +132,146 @@ class TeamSpeak3ServerAPI:
 
 		return response[0]
 
-	def get_version(self):
-		return self.do_request(f"/version")[0]
+	async def get_version(self):
+		return (await self.do_request(f"/version"))[0]
 
-	def get_channel_list(self) -> typing.List[typing.Dict[str, str]]:
-		query_params = {
-			"-flags": "",
-			"-limits": "",
-			"-secondsempty": ""
-		}
-		channel_list = self.do_request(f"/{self.virtual_server_id}/channellist", query_params)
+	async def get_channel_list(self) -> typing.List[typing.Dict[str, str]]:
+		channel_list = await self.do_request(f"/{self.virtual_server_id}/channellist", _CHANNEL_LIST_PARAMS)
 
 		for channel in channel_list:
 			# Replace cid with channel_id as it is more intuitive
-			channel["channel_id"] = channel["cid"]
-			del channel["cid"]
+			channel["channel_id"] = channel.pop("cid")
 
 		return channel_list
 
-	def get_online_clients(self) -> typing.List[typing.Dict[str, str]]:
-		query_params = {
-			"-away": "",
-			"-voice": "",
-			"-times": "",
-			"-groups": "",
-			"-country": ""
-		}
-		online_clients = self.do_request(f"/{self.virtual_server_id}/clientlist", query_params)
+	async def get_online_clients(self) -> typing.List[typing.Dict[str, str]]:
+		online_clients = await self.do_request(f"/{self.virtual_server_id}/clientlist", _ONLINE_CLIENT_PARAMS)
 
 		# Replace cid and clid by channel_id and online_client_id as it is more intuitive
 		# Also, replace client_database_id with known_client_id for consistency
 		for online_client in online_clients:
-			online_client["channel_id"] = online_client["cid"]
-			del online_client["cid"]
+			online_client["channel_id"] = online_client.pop("cid")
+			online_client["online_client_id"] = online_client.pop("clid")
+			online_client["known_client_id"] = online_client.pop("client_database_id")
 
-			online_client["online_client_id"] = online_client["clid"]
-			del online_client["clid"]
+		return online_clients
 
-			online_client["known_client_id"] = online_client["client_database_id"]
-			del online_client["client_database_id"]
+	async def get_known_clients(self) -> typing.List[typing.Dict[str, str]]:
+		async with self._known_clients_lock:
+			await self._update_known_clients_cache()
+			return list(self.known_clients_cache)
 
-		return online_clients
+	async def _update_known_clients_cache(self):
+		if time.monotonic() - self._known_clients_rebuilt_at >= KNOWN_CLIENTS_CACHE_MAX_AGE:
+			self.known_clients_cache = []
+			self._known_info_cache = {}
+
+		if self.known_clients_cache:
+			# Probe the last cached row. If it moved, clients were deleted and the cached offsets are invalid.
+			query_params = {"start": str(len(self.known_clients_cache) - 1), "duration": "1"}
+
+			try:
+				last_db_client = (await self.do_request(f"/{self.virtual_server_id}/clientdblist", query_params))[0]
+			except TS3EmptyResultSetError:
+				last_db_client = None
+
+			if last_db_client is None or last_db_client["cldbid"] != self.known_clients_cache[-1]["known_client_id"]:
+				self.known_clients_cache = []
+				self._known_info_cache = {}
 
-	def get_known_clients(self) -> typing.List[typing.Dict[str, str]]:
+		if not self.known_clients_cache:
+			self._known_clients_rebuilt_at = time.monotonic()
+
+		# Only fetch the pages after the cached clients
 		max_clients_per_page = 25
 		num_clients_in_page = max_clients_per_page
 
-		known_clients = []
 		while num_clients_in_page == max_clients_per_page:
-			query_params = {"start": str(len(known_clients))}
+			query_params = {"start": str(len(self.known_clients_cache))}
 
 			try:
-				clients_in_page = self.do_request(f"/{self.virtual_server_id}/clientdblist", query_params)
+				clients_in_page = await self.do_request(f"/{self.virtual_server_id}/clientdblist", query_params)
 			except TS3EmptyResultSetError as e:
 				break
 
-			known_clients.extend(clients_in_page)
-			num_clients_in_page = len(clients_in_page)
-
-		# Replace cldbid with known_client_id as it is more intuitive
-		for known_client in known_clients:
-			known_client["known_client_id"] = known_client["cldbid"]
-			del known_client["cldbid"]
+			# Replace cldbid with known_client_id as it is more intuitive
+			for known_client in clients_in_page:
+				known_client["known_client_id"] = known_client.pop("cldbid")
 
-		return known_clients
+			self.known_clients_cache.extend(clients_in_page)
+			num_clients_in_page = len(clients_in_page)
 
-	def get_online_client_info(self, online_client_id: str):
-		online_client = self.do_request_with_single_object_response(
+	async def get_online_client_info(self, online_client_id: str):
+		online_client = await self.do_request_with_single_object_response(
 			f"/{self.virtual_server_id}/clientinfo",
 			{"clid": online_client_id}
 		)
 
 		# Replace cid by channel_id as it is more intuitive
-		online_client["channel_id"] = online_client["cid"]
-		del online_client["cid"]
+		online_client["channel_id"] = online_client.pop("cid")
 
 		return online_client
 
-	def get_known_client_info(self, known_client_id: str):
-		return self.do_request_with_single_object_response(
+	async def get_known_client_info(self, known_client_id: str):
+		if self._is_known_client_info_cached(known_client_id):
+			return self._known_info_cache[known_client_id][1]
+
+		known_client_info = await self.do_request_with_single_object_response(
 			f"/{self.virtual_server_id}/clientdbinfo",
 			{"cldbid": known_client_id}
 		)
-
-	def get_server_name_description(self):
-		server_info = self.do_request(f"/{self.virtual_server_id}/serverinfo")[0]
+		self._known_info_cache[known_client_id] = (time.monotonic(), known_client_info)
+
+		return known_client_info
+
+	def _is_known_client_info_cached(self, known_client_id: str) -> bool:
+		cached = self._known_info_cache.get(known_client_id)
+		if cached is None:
+			return False
+
+		if time.monotonic() - cached[0] >= KNOWN_CLIENT_INFO_CACHE_TTL:
+			# Drop stale entries so that they do not pile up
+			del self._known_info_cache[known_client_id]
+			return False
+
+		return True
+
+	async def prefetch_known_client_infos(self, known_client_ids: typing.Iterable[str]) -> typing.Tuple[int, int]:
+		# Request the client infos in concurrent batches, failures are left for the next regular request
+		# Returns the number of fetched and failed client infos
+		batch_size = 16
+		known_client_ids = iter([
+			known_client_id for known_client_id in known_client_ids
+			if not self._is_known_client_info_cached(known_client_id)
+		])
+
+		num_fetched = 0
+		num_failed = 0
+		batch = list(itertools.islice(known_client_ids, batch_size))
+		while batch:
+			results = await asyncio.gather(
+				*[self.get_known_client_info(known_client_id) for known_client_id in batch],
+				return_exceptions=True
+			)
+
+			for result in results:
+				if isinstance(result, BaseException):
+					num_failed += 1
+				else:
+					num_fetched += 1
+
+			batch = list(itertools.islice(known_client_ids, batch_size))
+			if batch:
+				await asyncio.sleep(PREFETCH_BATCH_INTERVAL)
+
+		return num_fetched, num_failed
+
+	async def get_server_name_description(self):
+		server_info = (await self.do_request(f"/{self.virtual_server_id}/serverinfo"))[0]
 		return server_info["virtualserver_name"], server_info["virtualserver_welcomemessage"]
 
-	def get_channel_info(self, channel_id: str):
-		return self.do_request_with_single_object_response(
+	async def get_channel_info(self, channel_id: str):
+		return await self.do_request_with_single_object_response(
 			f"/{self.virtual_server_id}/channelinfo",
 			{"cid": channel_id}
 		)